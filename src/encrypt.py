@@ -1,23 +1,49 @@
-from cryptography.fernet import Fernet
+import io
+import os
+import tarfile
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
-# Generate a key for encryption (needed first time only)
-key = Fernet.generate_key()
+# Size of the random nonce prepended to the encrypted bundle (96 bits, as recommended for AES-GCM)
+NONCE_SIZE = 12
 
-# Save the key to a file (This file should be stored in cloud secret manager in prod env)
-with open("secret.key", "wb") as key_file:
-    key_file.write(key)
+# Secret files to bundle into the encrypted file (add new secrets here)
+SECRET_FILES = ["config.ini"]
 
-# Read the config file (I've removed config.ini file as it's needed first time only)
-with open("config.ini", "rb") as file:
-    config_data = file.read()
 
-# Encrypt the config data
-f = Fernet(key)
-encrypted_data = f.encrypt(config_data)
+def encrypt_files(file_paths, key, output_path):
+    """
+    Bundle the given files into a single tar archive and encrypt it with AES-GCM in one pass.
 
-# Write the encrypted config to a new file
-with open("config.ini.enc", "wb") as enc_file:
-    enc_file.write(encrypted_data)
+    Parameters:
+    - file_paths: list, paths of the files to bundle.
+    - key: bytes, the AES-GCM encryption key.
+    - output_path: str, path of the encrypted bundle, written as nonce || ciphertext || tag.
+    """
+    # Build the gzip-compressed tar archive in memory (compression also drops the tar record padding),
+    # each file is stored under its base name
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for file_path in file_paths:
+            tar.add(file_path, arcname=os.path.basename(file_path))
 
-print("Encryption complete. Config file saved as 'config.ini.enc'.")
-print("Store the 'secret.key' securely. It is needed for decryption.")
+    # Encrypt the whole bundle at once, the authentication tag is appended to the ciphertext
+    nonce = os.urandom(NONCE_SIZE)
+    encrypted_data = AESGCM(key).encrypt(nonce, buffer.getvalue(), None)
+
+    with open(output_path, "wb") as enc_file:
+        enc_file.write(nonce + encrypted_data)
+
+
+if __name__ == '__main__':
+    # Generate a key for encryption (needed first time only)
+    key = AESGCM.generate_key(bit_length=128)
+
+    # Save the key to a file (This file should be stored in cloud secret manager in prod env)
+    with open("secret.key", "wb") as key_file:
+        key_file.write(key)
+
+    # Encrypt the config file (I've removed config.ini file as it's needed first time only)
+    encrypt_files(SECRET_FILES, key, "config.ini.enc")
+
+    print("Encryption complete. Secret files saved as 'config.ini.enc'.")
+    print("Store the 'secret.key' securely. It is needed for decryption.")
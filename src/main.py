@@ -1,43 +1,63 @@
 import pandas as pd
 import os
+import io
+import csv
+import tarfile
 import logging
-import configparser
-from cryptography.fernet import Fernet
-from sqlalchemy import create_engine
+import functools
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy import create_engine, Numeric
 from sqlalchemy import text
 import streamlit as st
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Size of the nonce prepended to the encrypted secrets bundle by encrypt.py
+NONCE_SIZE = 12
 
-def decrypt_config_file(encrypted_file, key):
+# Format of the 'Date (UTC)' column in the transactions file, e.g. '1/1/24 7:00'
+TRANSACTION_DATE_FORMAT = '%m/%d/%y %H:%M'
+
+# Money columns are stored as NUMERIC(12, 2) so amounts stay exact in PostgreSQL
+MONEY_COLUMNS = ('total', 'amount', 'total_spending')
+
+# Translation table used to standardize column names in a single pass
+COLUMN_NAME_TABLE = str.maketrans({' ': '_', '(': '', ')': ''})
+
+
+def decrypt_config_file(encrypted_file, key, member='config.ini'):
     """
-    Decrypt the encrypted config file using the provided key.
+    Decrypt the encrypted secrets bundle using the provided key and return one of its files.
 
     Parameters:
-    - encrypted_file: str, path to the encrypted config file.
-    - key: bytes, the encryption key.
+    - encrypted_file: str, path to the encrypted bundle written by encrypt.py.
+    - key: bytes or AESGCM, the encryption key or an already constructed AESGCM instance.
+    - member: str, name of the file to read from the bundle (default is 'config.ini').
 
     Returns:
     - decrypted_data: str, decrypted content of the config file.
     """
-    f = Fernet(key)
+    aesgcm = key if isinstance(key, AESGCM) else AESGCM(key)
 
-    # Read the encrypted config file
-    with open(encrypted_file, "rb") as file:
-        encrypted_data = file.read()
+    # Read the encrypted bundle in one call
+    encrypted_data = Path(encrypted_file).read_bytes()
 
-    # Decrypt the data
-    decrypted_data = f.decrypt(encrypted_data)
+    # Split the nonce from the ciphertext and decrypt the whole bundle at once
+    nonce, ciphertext = encrypted_data[:NONCE_SIZE], encrypted_data[NONCE_SIZE:]
+    decrypted_data = aesgcm.decrypt(nonce, ciphertext, None)
 
-    # Return the decrypted data as a string
-    return decrypted_data.decode()
+    # Read the requested file from the decrypted gzip-compressed tar archive and return it as a string
+    with tarfile.open(fileobj=io.BytesIO(decrypted_data), mode='r:gz') as tar:
+        return tar.extractfile(member).read().decode()
 
 
 def read_db_config(decrypted_data):
     """
-    Parse the decrypted config data using configparser.
+    Parse the decrypted config data, a single [postgresql] section of key = value lines.
 
     Parameters:
     - decrypted_data: str, decrypted config data.
@@ -45,29 +65,38 @@ def read_db_config(decrypted_data):
     Returns:
     - db_config: dict, database connection information.
     """
-    config = configparser.ConfigParser()
+    config = {}
+    for line in decrypted_data.splitlines():
+        line = line.strip()
 
-    # Read the decrypted data into configparser
-    config.read_string(decrypted_data)
+        # Skip blank lines, comments and the section header
+        if '=' not in line or line.startswith(('#', ';', '[')):
+            continue
+
+        key, value = line.split('=', 1)
+        config[key.strip()] = value.strip()
 
     db_config = {
-        'user': config['postgresql']['user'],
-        'password': config['postgresql']['password'],
-        'host': config['postgresql']['host'],
-        'port': config['postgresql']['port'],
-        'database': config['postgresql']['database']
+        'user': config['user'],
+        'password': config['password'],
+        'host': config['host'],
+        'port': config['port'],
+        'database': config['database']
     }
 
     return db_config
 
 
-def load_tsv_file(file_path, delimiter='\t'):
+def load_tsv_file(file_path, delimiter='\t', chunksize=None):
     """
     Load a CSV/TSV file into a pandas DataFrame.
 
     Parameters:
     - file_path: str, the path to the CSV/TSV file.
     - delimiter: str, the delimiter used in the file (default is '\t' for TSV).
+    - chunksize: int, number of rows to read at a time for large files (optional).
+      Only one raw chunk is parsed at a time and duplicates within it are dropped before
+      concatenating, the concatenated result is still held in memory.
 
     Returns:
     - df: pandas DataFrame, the loaded data.
@@ -77,7 +106,13 @@ def load_tsv_file(file_path, delimiter='\t'):
         return None
 
     try:
-        df = pd.read_csv(file_path, delimiter=delimiter)
+        if chunksize:
+            # The pyarrow engine doesn't support chunked reading, so stream the file with the default engine
+            chunks = pd.read_csv(file_path, delimiter=delimiter, chunksize=chunksize, dtype_backend='pyarrow')
+            df = pd.concat([chunk.drop_duplicates() for chunk in chunks], ignore_index=True)
+        else:
+            # The pyarrow engine parses the file with multiple threads and keeps columns Arrow-backed
+            df = pd.read_csv(file_path, delimiter=delimiter, engine='pyarrow', dtype_backend='pyarrow')
         logging.info(f"Loaded {len(df)} records from {file_path}")
         return df
     except Exception as e:
@@ -85,7 +120,7 @@ def load_tsv_file(file_path, delimiter='\t'):
         return None
 
 
-def ingest_data(products_file, transactions_file, users_file):
+def ingest_data(products_file, transactions_file, users_file, transactions_chunksize=None):
     """
     Ingests data from three files: products, transactions, and users.
 
@@ -93,16 +128,31 @@ def ingest_data(products_file, transactions_file, users_file):
     - products_file: str, the path to the products file.
     - transactions_file: str, the path to the transactions file.
     - users_file: str, the path to the users file.
+    - transactions_chunksize: int, number of rows to read at a time from the transactions file (optional).
 
     Returns:
     - products_df: pandas DataFrame, the products data.
     - transactions_df: pandas DataFrame, the transactions data.
     - users_df: pandas DataFrame, the users data.
     """
-    # Load each file into a DataFrame
-    products_df = load_tsv_file(products_file)
-    transactions_df = load_tsv_file(transactions_file)
-    users_df = load_tsv_file(users_file)
+    # Load the files concurrently, sharing the CPU cores between pyarrow's parsing threads
+    files = [products_file, transactions_file, users_file]
+    chunksizes = [None, transactions_chunksize, None]
+    previous_cpu_count = pa.cpu_count()
+    pa.set_cpu_count(max(1, (os.cpu_count() or 1) // len(files)))
+    try:
+        with ThreadPoolExecutor(max_workers=len(files)) as executor:
+            futures = [executor.submit(load_tsv_file, file_path, chunksize=chunksize)
+                       for file_path, chunksize in zip(files, chunksizes)]
+            products_df, transactions_df, users_df = [future.result() for future in futures]
+    finally:
+        # Restore pyarrow's process-wide CPU pool size for any later work
+        pa.set_cpu_count(previous_cpu_count)
+
+    # Convert 'Customer ID' to categorical so grouping and deduplication work on integer codes
+    for df in (transactions_df, users_df):
+        if df is not None:
+            df['Customer ID'] = df['Customer ID'].astype('category')
 
     # Convert the date format in the transactions data
     if transactions_df is not None:
@@ -114,10 +164,9 @@ def ingest_data(products_file, transactions_file, users_file):
     if transactions_df is not None:
         transactions_df = remove_duplicates(transactions_df, 'transactions_df')
     if users_df is not None:
-        users_df = remove_duplicates(users_df, 'users_df').groupby('Customer ID').agg({
-            'Customer Name': 'last',  # Keeping the last customer name to have same names in everywhere
-            'Customer Email': 'last',  # Keeping the last customer email to have same email address in everywhere
-        }).reset_index()
+        users_df = remove_duplicates(users_df[['Customer ID', 'Customer Name', 'Customer Email']], 'users_df')
+        # Keeping the last non-null customer name and email to have same values in everywhere
+        users_df = users_df.groupby('Customer ID', sort=False, observed=True).last().reset_index()
 
     return products_df, transactions_df, users_df
 
@@ -135,7 +184,7 @@ def convert_date_format(transactions_df):
     # Check if the 'Date (UTC)' column exists
     if 'Date (UTC)' in transactions_df.columns:
         # Convert the 'Date (UTC)' column to the desired format
-        transactions_df['Date (UTC)'] = pd.to_datetime(transactions_df['Date (UTC)'], format="mixed")
+        transactions_df['Date (UTC)'] = pd.to_datetime(transactions_df['Date (UTC)'], format=TRANSACTION_DATE_FORMAT)
         logging.info("Date format converted to 'YYYY-MM-DD HH:MI:00'")
     else:
         logging.warning("Date (UTC) column not found in transactions data.")
@@ -170,10 +219,13 @@ def remove_duplicates(df, df_name):
     Returns:
     - df: pandas DataFrame, the DataFrame with duplicates removed.
     """
-    before = len(df)
-    df = df.drop_duplicates()
-    after = len(df)
-    logging.info(f"Removed {before - after} duplicate rows from {df_name}. Remaining rows: {after}")
+    duplicated = df.duplicated()
+    removed = int(duplicated.sum())
+
+    # Only slice the DataFrame when there is something to remove, to avoid copying it needlessly
+    if removed:
+        df = df.loc[~duplicated]
+    logging.info(f"Removed {removed} duplicate rows from {df_name}. Remaining rows: {len(df)}")
     return df
 
 
@@ -185,39 +237,48 @@ def calculate_total_spending_per_user(transactions_df):
     - transactions_df: pandas DataFrame, the transactions data.
 
     Returns:
-    - spending_per_user_df: pandas DataFrame, total spending per user.
+    - spending_per_user: pandas Series, total spending per user indexed by Customer ID.
     """
-    # Group by 'Customer ID' and calculate total spending
-    spending_per_user_df = transactions_df.groupby('Customer ID', as_index=False)['Total'].sum()
-    spending_per_user_df.rename(columns={'Total': 'Total Spending'}, inplace=True)
+    # Select only the key and value columns, then group by 'Customer ID' and calculate total spending
+    # (only observed categories, no need to sort the groups)
+    spending_per_user = transactions_df[['Customer ID', 'Total']]\
+        .groupby('Customer ID', observed=True, sort=False)['Total']\
+        .sum()
 
-    return spending_per_user_df
+    return spending_per_user
 
 
-def add_total_spending_to_users(users_df, spending_per_user_df):
+def add_total_spending_to_users(users_df, spending_per_user):
     """
-    Add the 'Total Spending' column to the users DataFrame by merging with spending_per_user_df.
+    Add the 'Total Spending' column to the users DataFrame by mapping each Customer ID to its spending.
 
     Parameters:
     - users_df: pandas DataFrame, the users data.
-    - spending_per_user_df: pandas DataFrame, total spending per user.
+    - spending_per_user: pandas Series, total spending per user indexed by Customer ID.
 
     Returns:
     - updated_users_df: pandas DataFrame, the users data with total spending column.
     """
-    # Merge total spending with users_df
-    updated_users_df = pd.merge(users_df, spending_per_user_df, on='Customer ID', how='left')
-
-    # Fill NaN values in 'Total Spending' with 0 (in case some users have no transactions)
-    updated_users_df['Total Spending'] = updated_users_df['Total Spending'].fillna(0)
+    # Look up total spending per user and fill NaN values with 0 (in case some users have no transactions).
+    # Mapping a categorical 'Customer ID' can return a categorical, so cast the result to float explicitly
+    updated_users_df = users_df.assign(**{
+        'Total Spending': users_df['Customer ID'].map(spending_per_user).astype('float64').fillna(0)
+    })
 
     return updated_users_df
 
 
+@functools.lru_cache(maxsize=1)
+def get_cipher():
+    # Build the AESGCM instance once and reuse it for every decryption
+    key = Path("src/secret.key").read_bytes()
+    return AESGCM(key)
+
+
+@functools.lru_cache(maxsize=1)
 def get_db_config():
-    # Load and decrypt the config file
-    key = open("src/secret.key", "rb").read()
-    decrypted_config = decrypt_config_file("src/config.ini.enc", key)
+    # Load and decrypt the config file (cached, so repeated calls skip file I/O and decryption)
+    decrypted_config = decrypt_config_file("src/config.ini.enc", get_cipher())
 
     # Parse the database configuration
     return read_db_config(decrypted_config)
@@ -233,59 +294,107 @@ def standardize_column_names(df):
     Returns:
     - df: pandas DataFrame, the DataFrame with standardized column names.
     """
-    df.columns = df.columns.str.replace(' ', '_')\
-        .str.replace('(', '')\
-        .str.replace(')', '')\
-        .str.lower()
+    df.columns = [column.translate(COLUMN_NAME_TABLE).lower() for column in df.columns]
     return df
 
 
+def psql_insert_copy(table, conn, keys, data_iter):
+    """
+    Insert rows with PostgreSQL COPY, used as the `method` of DataFrame.to_sql.
+
+    Parameters:
+    - table: pandas.io.sql.SQLTable, the table being written.
+    - conn: SQLAlchemy connection.
+    - keys: list, the column names.
+    - data_iter: iterable, the rows to insert.
+    """
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cur:
+        # Write the rows into an in-memory CSV buffer and stream it to the server in one COPY
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(data_iter)
+        buffer.seek(0)
+
+        columns = ', '.join(f'"{key}"' for key in keys)
+        table_name = f'{table.schema}.{table.name}' if table.schema else table.name
+        cur.copy_expert(sql=f'COPY {table_name} ({columns}) FROM STDIN WITH CSV', file=buffer)
+
+
 def save_to_postgres(engine, df, table_name, primary_key=None):
     """
     Save a pandas DataFrame to a PostgreSQL database after standardizing column names
     and optionally add a primary key constraint.
 
+    The primary key is declared in the CREATE TABLE statement, and the table drop, creation
+    and COPY of the data all run in a single transaction.
+
     Parameters:
     - engine: SQLAlchemy engine connected to PostgreSQL.
     - df: pandas DataFrame, the data to save.
     - table_name: str, the name of the table to save the data.
-    - primary_key: str, the column name to use as the primary key (optional).
+    - primary_key: str or list, the column name(s) to use as the primary key (optional).
     """
-    # Standardize the column names
+    # Standardize the column names and store money columns as exact NUMERIC values
     df = standardize_column_names(df)
+    money_dtypes = {column: Numeric(12, 2) for column in MONEY_COLUMNS if column in df.columns}
 
-    df.to_sql(table_name, engine, if_exists='replace', index=False)
-    logging.info(f"Data saved to table '{table_name}'")
+    with engine.connect() as conn:
+        # Recreate the table with the primary key constraint (if provided) in its schema
+        conn.execute(text(f'DROP TABLE IF EXISTS {table_name};'))
+        create_query = pd.io.sql.get_schema(df, table_name, keys=primary_key, con=conn, dtype=money_dtypes)
+        conn.execute(text(create_query))
+        if primary_key:
+            logging.info(f"Table '{table_name}' created with primary key '{primary_key}'.\n"
+                         f"Create_query: '{create_query}'")
 
-    # Add primary key constraint if provided
-    if primary_key:
-        if isinstance(primary_key, list):
-            pk_columns = ', '.join(primary_key)  # Join the columns with commas for composite PK
-        else:
-            pk_columns = primary_key  # Single column primary key
+        # Load the data within the same transaction as the table creation
+        df.to_sql(table_name, conn, if_exists='append', index=False, method=psql_insert_copy, chunksize=100_000)
+        conn.commit()
+        logging.info(f"Data saved to table '{table_name}'")
 
-        with engine.connect() as conn:
-            alter_query = f'ALTER TABLE {table_name} ADD PRIMARY KEY ({pk_columns});'
-            conn.execute(text(alter_query))
-            conn.commit()
-            logging.info(f"Primary key '{pk_columns}' added to table '{table_name}'.\n"
-                         f"Alter_query: '{alter_query}'")
 
+def add_total_spending_in_postgres(engine, users_table='dim_user', transactions_table='fct_transaction'):
+    """
+    Add the 'total_spending' column to the users table, aggregating the transactions inside PostgreSQL.
 
+    Parameters:
+    - engine: SQLAlchemy engine connected to PostgreSQL.
+    - users_table: str, the users table to add total spending to (default is 'dim_user').
+    - transactions_table: str, the transactions table to aggregate (default is 'fct_transaction').
+    """
+    with engine.connect() as conn:
+        # Users without transactions keep the default total spending of 0
+        alter_query = (f'ALTER TABLE {users_table} '
+                       f'ADD COLUMN total_spending NUMERIC(12, 2) NOT NULL DEFAULT 0;')
+        conn.execute(text(alter_query))
+
+        update_query = (f'UPDATE {users_table} u SET total_spending = s.total '
+                        f'FROM (SELECT customer_id, SUM(total) AS total '
+                        f'FROM {transactions_table} GROUP BY customer_id) s '
+                        f'WHERE u.customer_id = s.customer_id;')
+        conn.execute(text(update_query))
+        conn.commit()
+        logging.info(f"Total spending added to table '{users_table}'.\n"
+                     f"Update_query: '{update_query}'")
+
+
+@functools.lru_cache(maxsize=1)
 def get_postgres_engine():
     db_config = get_db_config()
 
-    # Create the PostgreSQL engine
+    # Create the PostgreSQL engine once, its connection pool is reused by every save and query
     engine = create_engine(
-        f'postgresql://{db_config["user"]}:{db_config["password"]}@{db_config["host"]}:{db_config["port"]}/{db_config["database"]}')
+        f'postgresql://{db_config["user"]}:{db_config["password"]}@{db_config["host"]}:{db_config["port"]}/{db_config["database"]}',
+        pool_pre_ping=True,
+        pool_size=5)
 
     logging.info(f"Successfully connected to PostgreSQL database {db_config['database']} at {db_config['host']}")
 
     return engine
 
 
-# Query data from PostgreSQL
-@st.cache_resource
+# Query data from PostgreSQL (results are cached per query for 10 minutes, the engine is shared)
+@st.cache_data(ttl=600, show_spinner=False)
 def query_data(query):
     engine = get_postgres_engine()
     with engine.connect() as conn:
@@ -303,14 +412,8 @@ if __name__ == '__main__':
 
     products_df, transactions_df, users_df = ingest_data(products_file, transactions_file, users_file)
 
-    # Calculate total spending per user
-    spending_per_user_df = calculate_total_spending_per_user(transactions_df)
-
-    # Add total spending as a new column in the users DataFrame
-    updated_users_df = add_total_spending_to_users(users_df, spending_per_user_df)
-
     # Log example rows from final users_df
-    log_example_rows(updated_users_df, 'users_df')
+    log_example_rows(users_df, 'users_df')
 
     # Open postgres connection and get the engine
     engine = get_postgres_engine()
@@ -318,4 +421,7 @@ if __name__ == '__main__':
     # Save the DataFrames to the PostgreSQL database
     save_to_postgres(engine, products_df, 'dim_product', primary_key=['subscription_id', 'plan'])
     save_to_postgres(engine, transactions_df, 'fct_transaction', primary_key='transaction_id')
-    save_to_postgres(engine, updated_users_df, 'dim_user', primary_key='customer_id')
\ No newline at end of file
+    save_to_postgres(engine, users_df, 'dim_user', primary_key='customer_id')
+
+    # Calculate total spending per user inside PostgreSQL and add it into dim_user
+    add_total_spending_in_postgres(engine)
\ No newline at end of file
@@ -1,7 +1,6 @@
 import sys
 import streamlit as st
 import altair as alt
-import matplotlib.pyplot as plt
 sys.path.append("src")
 from main import query_data
 import pandas as pd
@@ -101,26 +100,15 @@ def plot_monthly_revenue_growth():
     # Convert the revenue growth to a percentage for better readability
     revenue_growth_df['revenue_growth'] = revenue_growth_df['revenue_growth'].round(2)
 
-    # Define colors: green for growth, red for drop
-    colors = ['green' if x >= 0 else 'red' for x in revenue_growth_df['revenue_growth']]
-
-    # Plotting with Matplotlib
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.bar(revenue_growth_df['month'].dt.strftime('%Y-%m'), revenue_growth_df['revenue_growth'], color=colors)
-
-    # Formatting the plot
-    ax.set_xlabel('Month', fontsize=12)
-    ax.set_ylabel('Revenue Growth (%)', fontsize=12)
-    ax.set_title('Monthly Revenue Growth (Last 6 Months)', fontsize=14)
-
-    # Rotate x-axis labels for better readability
-    ax.set_xticklabels(revenue_growth_df['month'].dt.strftime('%Y-%m'), rotation=45, ha='right')
-
-    # Add grid for better visibility
-    ax.grid(True, axis='y', linestyle='--', alpha=0.7)
-
-    # Display the plot in Streamlit
-    st.pyplot(fig)
+    # Plotting with Altair, green for growth and red for drop
+    chart = alt.Chart(revenue_growth_df).mark_bar().encode(
+        x=alt.X('yearmonth(month):O', title='Month', axis=alt.Axis(labelAngle=-45)),
+        y=alt.Y('revenue_growth:Q', title='Revenue Growth (%)'),
+        color=alt.condition('datum.revenue_growth >= 0', alt.value('green'), alt.value('red'))
+    ).properties(
+        title='Monthly Revenue Growth (Last 6 Months)'
+    )
+    st.altair_chart(chart, use_container_width=True)
 
 
 if __name__ == '__main__':